@@ -1,15 +1,89 @@
 #Praggnya Kanungo
 #DS 4003
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlencode, urlparse
+
 import dash
-from dash import dcc, html
-from dash.dependencies import Input, Output
+from dash import ctx, dcc, html
+from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
+from flask import Response, abort, has_request_context, jsonify, request
+import numpy as np
 import plotly.express as px
+import plotly.graph_objects as go
 import pandas as pd
+from scipy.cluster.hierarchy import leaves_list, linkage
+
+from country_search import CountrySearchIndex
+from data_quality import summarize_report, validate_dataset
+from forecast import FORECAST_MAX_YEARS, fit_forecasts
+
+# pyarrow is only needed for the Parquet export, so the app still runs without it
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+logger = logging.getLogger(__name__)
 
 # Load the data
 #data_path = r"C:\Users\pragg\Downloads\data.csv"
 #data = pd.read_csv(data_path)
-data = pd.read_csv("data/co2_per_capita.csv")
+DATA_PATH = os.environ.get("DATA_PATH", "data/co2_per_capita.csv")
+
+# Fill missing years inside a country's range by interpolation (those rows are flagged in the interpolated column)
+DATA_INTERPOLATE = os.environ.get("DATA_INTERPOLATE", "0") == "1"
+
+# How often (in seconds) a request checks whether the csv on disk changed
+DATASET_CHECK_SECONDS = 30
+
+# Cleaned data, matrix, validation report, fitted projections and country search index of the current dataset
+# version (hash of the csv), so a csv that was touched but not changed is not processed again.
+# Only the current version is kept, older ones would otherwise stay in every worker for its whole life
+datasets = {}
+dataset_state = {"version": None, "stat": None, "checked": 0.0}
+
+
+def load_dataset():
+    # Reading the csv and running the validation stage, the projection fit and the search index build on it, only if
+    # this version was not seen before. Sets the data, co2_matrix, data_report, forecasts and country_index globals
+    # and returns True when the version changed
+    global data, co2_matrix, data_report, forecasts, country_index
+    stat = os.stat(DATA_PATH)
+    with open(DATA_PATH, "rb") as f:
+        raw_bytes = f.read()
+    version = hashlib.sha1(raw_bytes).hexdigest()[:12]
+    if version not in datasets:
+        cleaned, matrix, report = validate_dataset(pd.read_csv(io.BytesIO(raw_bytes)), interpolate=DATA_INTERPOLATE)
+        report["version"] = version
+        datasets.clear()
+        datasets[version] = (cleaned, matrix, report, fit_forecasts(matrix), CountrySearchIndex(matrix.index))
+        # Gaps and outliers are part of the data (the shipped csv has a few), only rows that could not be used as they are
+        # are worth a warning
+        problems = report["invalid_rows"] + report["non_numeric_values"] + report["duplicates"]
+        logger.log(logging.WARNING if problems else logging.INFO,
+                   "Dataset %s validated:\n%s", version, summarize_report(report))
+
+    changed = version != dataset_state["version"]
+    # data is the long table, co2_matrix the same values as a country x year matrix so comparisons are plain array slices
+    # forecasts the projections of every country, fitted once here so callbacks only look them up,
+    # and country_index the fuzzy search behind the country dropdowns
+    data, co2_matrix, data_report, forecasts, country_index = datasets[version]
+    dataset_state.update(version=version, stat=(stat.st_mtime_ns, stat.st_size), checked=time.time())
+    return changed
+
+
+load_dataset()
 
 # Dash app initialization with external Bootstrap stylesheet
 app = dash.Dash(
@@ -109,6 +183,139 @@ data_source_info = html.Div(
     ],
 )
 
+# Rows per chunk when streaming an export, so memory stays flat no matter how big the selection is
+EXPORT_CHUNK_ROWS = 5000
+
+# How much memory (in MB of figure JSON, per worker) the figure cache may hold, the default selections do not count
+FIGURE_CACHE_MB = int(os.environ.get("FIGURE_CACHE_MB", 64))
+
+# How many matches a country dropdown gets back for what was typed
+COUNTRY_SEARCH_LIMIT = 10
+
+# Above this many countries the multiple country line graph turns into small multiples,
+# and above the second limit into a heatmap, since one colored line per country stops being readable
+COMPARISON_LINE_LIMIT = int(os.environ.get("COMPARISON_LINE_LIMIT", 12))
+COMPARISON_SMALL_MULTIPLES_LIMIT = int(os.environ.get("COMPARISON_SMALL_MULTIPLES_LIMIT", 30))
+
+# What the multiple country graphs can show, and the axis title for each
+comparison_metrics = {
+    "raw": "CO2 Per Capita",
+    "indexed": "Index (First Nonzero Year = 100)",
+    "growth": "Growth Per Year (%)",
+}
+
+# How many years ahead the projection buttons offer, every 10 years up to what the forecasts are fitted for
+forecast_horizons = ("0",) + tuple(str(years) for years in range(10, FORECAST_MAX_YEARS + 1, 10))
+
+# Display options a mode keeps in the URL next to its selection, the first value of each is the default
+mode_options = {
+    "worldview": {
+        "chart": ("lines", "heatmap"),
+        "order": ("total", "cluster", "name"),
+        "scale": ("linear", "log"),
+    },
+    "single_country": {
+        "ahead": forecast_horizons,
+    },
+    "multiple_country": {
+        "metric": tuple(comparison_metrics),
+        "ahead": forecast_horizons,
+    },
+}
+
+
+def worldview_options(chart, order, scale):
+    # Row order and color scale only mean something for the heatmap, so the line graph always gets
+    # the defaults and is cached once instead of once per heatmap setting
+    if chart != "heatmap":
+        defaults = mode_options["worldview"]
+        return chart, defaults["order"][0], defaults["scale"][0]
+    return chart, order, scale
+
+
+def heatmap_options_style(chart):
+    # The heatmap's radios are hidden while the line graph is shown
+    return {"display": "flex"} if chart == "heatmap" else {"display": "none"}
+
+
+def selection_params(countries=None, start=None, end=None):
+    # The query parameters I use for a selection, shared by the export links and the page URL
+    params = [("country", country) for country in (countries or [])]
+    if start is not None:
+        params.append(("start", start))
+    if end is not None:
+        params.append(("end", end))
+    return params
+
+
+def export_hrefs(countries=None, start=None, end=None):
+    # Building the export URLs for the current selection (one for CSV, one for Parquet)
+    query = urlencode(selection_params(countries, start, end))
+    return f"/export/csv?{query}", f"/export/parquet?{query}"
+
+
+def country_export_hrefs(countries, start, end):
+    # In the country modes no country means nothing is shown, while an export link without countries
+    # means every country, so the buttons get no link at all until something is selected
+    return export_hrefs(countries, start, end) if countries else (None, None)
+
+
+def selection_search(mode, countries=None, start=None, end=None, options=None):
+    # The "?mode=...&country=..." part of a shareable link for the current selection
+    params = [("mode", mode)] + selection_params(countries, start, end)
+    params += [(key, value) for key, value in (options or {}).items() if value is not None]
+    return "?" + urlencode(params)
+
+
+def export_buttons(prefix, hrefs):
+    # Download buttons for a mode, the hrefs are kept up to date by that mode's selection callback
+    csv_href, parquet_href = hrefs
+    return html.Div(
+        children=[
+            html.A(
+                "Download CSV",
+                id=f"{prefix}-export-csv",
+                href=csv_href,
+                className="btn btn-outline-primary",
+                style={"margin-right": "10px"},
+            ),
+            html.A(
+                "Download Parquet",
+                id=f"{prefix}-export-parquet",
+                href=parquet_href,
+                className="btn btn-outline-primary",
+            ),
+        ],
+        style={"display": "flex", "justify-content": "flex-end", "padding-top": "10px"},
+    )
+
+
+def country_options(countries, query=None):
+    # Dropdown options for just these countries. The typed text goes along as each option's search text,
+    # so the dropdown's own filtering keeps the alias and fuzzy matches the server picked
+    return [
+        {"label": country, "value": country, **({"search": query} if query else {})}
+        for country in countries
+    ]
+
+
+def forecast_selector(component_id, value):
+    # How many years to project ahead, the values are strings because they also go into the URL
+    return dcc.RadioItems(
+        id=component_id,
+        options=[{"label": "No Projection", "value": "0"}] + [
+            {"label": f"Project {years} Years", "value": years}
+            for years in forecast_horizons[1:]
+        ],
+        value=value,
+        inputClassName="btn-check",
+        labelClassName="btn btn-outline-primary",
+        labelStyle={"margin-right": "10px"},
+        inline=True,
+        style={"padding-top": "10px"},
+    )
+
+
 mode_descriptions = {
     "worldview": "In the Worldview mode, you can explore CO2 emissions per capita across all countries over a chosen time range. These graphs show trends over time and the distribution of emissions across the globe.",
     "single_country": "In the Single Country View mode, you can analyze CO2 emissions for a specific country over a selected period. This mode allows you to understand how emissions have changed within a particular country over time",
@@ -116,122 +323,213 @@ mode_descriptions = {
     "year_view": "In the Year View mode, you can analyze CO2 emissions per capita for a specific year across various countries. This mode helps you visually identify the trend in a year."
 }
 
+mode_labels = {
+    "worldview": "Worldview",
+    "single_country": "Single Country View",
+    "multiple_country": "Multiple Country View",
+    "year_view": "Year View",
+}
+
+
+def default_selection(mode):
+    # What each mode shows before the user touches anything
+    first_year, last_year = data["year"].min(), data["year"].max()
+    if mode == "single_country":
+        selection = {"countries": ["USA"], "start": first_year, "end": last_year}
+    elif mode == "multiple_country":
+        selection = {"countries": ["USA", "China"], "start": first_year, "end": last_year}
+    elif mode == "year_view":
+        selection = {"countries": [], "start": last_year, "end": last_year}
+    else:
+        selection = {"countries": [], "start": first_year, "end": last_year}
+    for key, values in mode_options.get(mode, {}).items():
+        selection[key] = values[0]
+    return selection
+
+
+def selection_from_url(url):
+    # Reading the mode and selection back out of a shared link, anything unknown falls back to the defaults
+    query = parse_qs(urlparse(url or "").query)
+    mode = query.get("mode", ["worldview"])[0]
+    if mode not in mode_descriptions:
+        mode = "worldview"
+    selection = default_selection(mode)
+
+    known_countries = set(data["country"].unique())
+    countries = [country for country in query.get("country", []) if country in known_countries]
+    if countries and mode in ("single_country", "multiple_country"):
+        selection["countries"] = countries[:1] if mode == "single_country" else countries
+
+    first_year, last_year = data["year"].min(), data["year"].max()
+    for key in ("start", "end"):
+        try:
+            selection[key] = min(max(int(query[key][0]), first_year), last_year)
+        except (KeyError, ValueError):
+            pass
+    for key, values in mode_options.get(mode, {}).items():
+        if query.get(key, [None])[0] in values:
+            selection[key] = query[key][0]
+    if mode == "year_view":
+        selection["start"] = selection["end"]
+    elif selection["start"] > selection["end"]:
+        selection["start"], selection["end"] = selection["end"], selection["start"]
+    return mode, selection
+
 # This is my block for the App layout
 # this is for defining the HTML layout using Dash HTML components
-app.layout = html.Div([
-    navbar,  # Include the navbar at the top
+# It is a function so a shared link opens straight on the mode and figures it points to.
+# The browser sends the page URL as the referrer when it fetches the layout, so that is where the selection comes from
+def serve_layout():
+    mode, selection = selection_from_url(request.referrer if has_request_context() else None)
+    return html.Div([
+        dcc.Location(id="url", refresh=False),
+        # The search string the selection callbacks last wrote, so a URL that differs from it came from Back/Forward
+        dcc.Store(id="shown-search"),
+        navbar,  # Include the navbar at the top
     
-    # Section for dashboard title and card-styled description
-    html.Div(
-        className="d-flex justify-content-between align-items-center",
-        style={"padding": "20px"},  # Padding for visual appeal
-        children=[
-            # Dashboard title and card-styled description occupying 50% of the width
-            html.Div(
-                className="d-flex flex-column justify-content-center align-items-center",
-                style={"width": "50%"},  # 50% of the section's width
-                children=[
+        # Section for dashboard title and card-styled description
+        html.Div(
+            className="d-flex justify-content-between align-items-center",
+            style={"padding": "20px"},  # Padding for visual appeal
+            children=[
+                # Dashboard title and card-styled description occupying 50% of the width
+                html.Div(
+                    className="d-flex flex-column justify-content-center align-items-center",
+                    style={"width": "50%"},  # 50% of the section's width
+                    children=[
         
-                    # Dashboard description in a card
-                    html.Div(
-                        className="card border-primary mb-3",
-                        style={"width": "100%"},  # Take full width of its parent div
-                        children=[
-                            html.Div("     ", className="card-header"),
-                            html.Div(
-                                className="card-body",
-                                children=[
-                                    html.H4("Welcome to the CO2 Emissions Per Capita Dashboard!", className="card-title"),
-                                    html.P(
-                                        "Welcome to the CO2 Emissions Per Capita Dashboard. This platform helps you explore carbon dioxide emissions from different countries over time, providing insights into trends, distributions, and comparisons on a global scale. Through interactive graphs, you can visualize how CO2 emissions per capita have changed across various regions, offering a unique perspective on our planet's environmental challenges. But this dashboard is more than just a collection of data—it's a call to action. As you explore the information, consider the broader impact of carbon emissions on climate change and what it means for future generations. This is your chance to understand the urgency of reducing emissions and inspire others to take action. Whether through individual choices or political advocacy, every effort counts in the fight against climate change. Use this dashboard as a catalyst for change, both in your life and in your community, to help build a more sustainable world.",
-                                        className="card-text",
-                                    ),
-                                ],
-                            ),
-                        ],
-                    ),
-                ],
-            ),
+                        # Dashboard description in a card
+                        html.Div(
+                            className="card border-primary mb-3",
+                            style={"width": "100%"},  # Take full width of its parent div
+                            children=[
+                                html.Div("     ", className="card-header"),
+                                html.Div(
+                                    className="card-body",
+                                    children=[
+                                        html.H4("Welcome to the CO2 Emissions Per Capita Dashboard!", className="card-title"),
+                                        html.P(
+                                            "Welcome to the CO2 Emissions Per Capita Dashboard. This platform helps you explore carbon dioxide emissions from different countries over time, providing insights into trends, distributions, and comparisons on a global scale. Through interactive graphs, you can visualize how CO2 emissions per capita have changed across various regions, offering a unique perspective on our planet's environmental challenges. But this dashboard is more than just a collection of data—it's a call to action. As you explore the information, consider the broader impact of carbon emissions on climate change and what it means for future generations. This is your chance to understand the urgency of reducing emissions and inspire others to take action. Whether through individual choices or political advocacy, every effort counts in the fight against climate change. Use this dashboard as a catalyst for change, both in your life and in your community, to help build a more sustainable world.",
+                                            className="card-text",
+                                        ),
+                                    ],
+                                ),
+                            ],
+                        ),
+                    ],
+                ),
             
-            # Section for mode display, mode description, and radio buttons
-            html.Div(
-                className="d-flex flex-column justify-content-center align-items-center",
-                style={"width": "50%"},  # Remaining 50% of the section's width
-                children=[
-                    html.H2(  # Update to H2 for current mode text
-                        id="current-mode",
-                        children=["Your current mode is: Worldview"],
-                        style={"font-family": "Arial, sans-serif"},  # Consistent font
-                    ),
-                    html.Div(
-                        id="mode-description",
-                        style={"font-size": "1em", "text-align": "center", "margin-top": "10px", "margin-bottom": "20px"},  # Extra space below description
-                        children=[mode_descriptions["worldview"]],
-                    ),
-                    dcc.RadioItems(
-                        id="mode-selector",
-                        options=[
-                            {"label": "Worldview", "value": "worldview"},
-                            {"label": "Single Country View", "value": "single_country"},
-                            {"label": "Multiple Country View", "value": "multiple_country"},
-                            {"label": "Year View", "value": "year_view"},
-                        ],
-                        value="worldview",  # Default selected value
-                        inputClassName="btn-check",
-                        labelClassName="btn btn-outline-primary",
-                        labelStyle={"margin-right": "10px"},
-                        inline=True,
-                    ),
-                ],
-            ),
-        ],
-    ),
+                # Section for mode display, mode description, and radio buttons
+                html.Div(
+                    className="d-flex flex-column justify-content-center align-items-center",
+                    style={"width": "50%"},  # Remaining 50% of the section's width
+                    children=[
+                        html.H2(  # Update to H2 for current mode text
+                            id="current-mode",
+                            children=[f"Your current mode is: {mode_labels[mode]}"],
+                            style={"font-family": "Arial, sans-serif"},  # Consistent font
+                        ),
+                        html.Div(
+                            id="mode-description",
+                            style={"font-size": "1em", "text-align": "center", "margin-top": "10px", "margin-bottom": "20px"},  # Extra space below description
+                            children=[mode_descriptions[mode]],
+                        ),
+                        dcc.RadioItems(
+                            id="mode-selector",
+                            options=[
+                                {"label": "Worldview", "value": "worldview"},
+                                {"label": "Single Country View", "value": "single_country"},
+                                {"label": "Multiple Country View", "value": "multiple_country"},
+                                {"label": "Year View", "value": "year_view"},
+                            ],
+                            value=mode,  # Mode from the URL, Worldview by default
+                            inputClassName="btn-check",
+                            labelClassName="btn btn-outline-primary",
+                            labelStyle={"margin-right": "10px"},
+                            inline=True,
+                        ),
+                    ],
+                ),
+            ],
+        ),
     
-    # Content to be updated based on mode selection
-    html.Div(
-        id="mode-display",
-        style={"padding": "20px"},
-    ),
+        # Content to be updated based on mode selection
+        html.Div(
+            id="mode-display",
+            style={"padding": "20px"},
+            children=render_mode_content(mode, selection),
+        ),
+
+        html.Div(
+            children=[data_source_info],  # Placing the new text card at the end!
+            style={"padding": "20px"},  # Padding for consistency so it doesnt look squished
+        ),
+    ])
+
 
-    html.Div(
-        children=[data_source_info],  # Placing the new text card at the end!
-        style={"padding": "20px"},  # Padding for consistency so it doesnt look squished
-    ),
-])
+app.layout = serve_layout
 
 
 # Callback to update the current mode display
+# None of the layout callbacks run on page load, serve_layout already rendered everything the URL asked for
 @app.callback(
     Output("current-mode", "children"),
-    [Input("mode-selector", "value")]
+    [Input("mode-selector", "value")],
+    prevent_initial_call=True,
 )
 def update_current_mode(mode):
-    mode_dict = {
-        "worldview": "Worldview",
-        "single_country": "Single Country View",
-        "multiple_country": "Multiple Country View",
-        "year_view": "Year View",
-    }
-    return [f"Your current mode is: {mode_dict[mode]}"]
+    return [f"Your current mode is: {mode_labels[mode]}"]
 
+# Every selection change pushes a browser history entry, so Back and Forward change the URL to an older selection
+# and the page has to be rendered again from it. A URL the selection callbacks just wrote themselves is skipped
 @app.callback(
     [
+        Output("mode-selector", "value"),
         Output("mode-description", "children"), 
         Output("mode-display", "children")
     ],  # Update the description and content
     [
-        Input("mode-selector", "value")
-    ]
+        Input("mode-selector", "value"),
+        Input("url", "search"),
+    ],
+    [State("shown-search", "data")],
+    prevent_initial_call=True,
 )
-def update_mode_content(mode):
+def update_mode_content(mode, search, shown_search):
+    if ctx.triggered_id == "url":
+        if search == shown_search:
+            raise PreventUpdate
+        mode, selection = selection_from_url(search)
+        selected_mode = mode
+    else:
+        selection = default_selection(mode)
+        selected_mode = dash.no_update
+
     # Define the mode description based on the selected mode
     mode_description = mode_descriptions.get(mode, "Unknown mode")
-    
+
+    # Returning here the mode description and content
+    return selected_mode, mode_description, render_mode_content(mode, selection)
+
+
+def render_mode_content(mode, selection):
+    # Building the controls of a mode for the given selection, with its figures already filled in
+    # from the figure cache so switching modes does not need a second round trip for the graphs.
+    # The default selection is what every mode switch and plain link shows, so its figures stay pinned in the cache
+    with figure_cache.pinning(selection == default_selection(mode)):
+        return mode_content(mode, selection)
+
+
+def mode_content(mode, selection):
+    countries, start, end = selection["countries"], selection["start"], selection["end"]
+
     # Initialize the content variable
     content = None
 
     # Worldview mode
     if mode == "worldview":
+        chart, order, scale = selection["chart"], selection["order"], selection["scale"]
+        line_fig, histogram_fig = worldview_figures(start, end, *worldview_options(chart, order, scale))
         content = html.Div(
             children=[
                 # RangeSlider for selecting years
@@ -239,17 +537,67 @@ def update_mode_content(mode):
                     id="worldview-year-slider",
                     min=data["year"].min(),
                     max=data["year"].max(),
-                    value=[data["year"].min(), data["year"].max()],
+                    value=[start, end],
                     marks={str(year): str(year) for year in range(data["year"].min(), data["year"].max() + 1, 10)},
                     step=1,
                 ),
+                # Line graph or heatmap, and for the heatmap how to order the rows and scale the colors
+                html.Div(
+                    children=[
+                        dcc.RadioItems(
+                            id="worldview-chart",
+                            options=[
+                                {"label": "Line Graph", "value": "lines"},
+                                {"label": "Heatmap", "value": "heatmap"},
+                            ],
+                            value=chart,
+                            inputClassName="btn-check",
+                            labelClassName="btn btn-outline-primary",
+                            labelStyle={"margin-right": "10px"},
+                            inline=True,
+                        ),
+                        html.Div(
+                            id="heatmap-options",
+                            children=[
+                                dcc.RadioItems(
+                                    id="heatmap-order",
+                                    options=[
+                                        {"label": "Order by Total", "value": "total"},
+                                        {"label": "Order by Cluster", "value": "cluster"},
+                                        {"label": "Order by Name", "value": "name"},
+                                    ],
+                                    value=order,
+                                    inputClassName="btn-check",
+                                    labelClassName="btn btn-outline-primary",
+                                    labelStyle={"margin-right": "10px"},
+                                    inline=True,
+                                ),
+                                dcc.RadioItems(
+                                    id="heatmap-scale",
+                                    options=[
+                                        {"label": "Linear Colors", "value": "linear"},
+                                        {"label": "Log Colors", "value": "log"},
+                                    ],
+                                    value=scale,
+                                    inputClassName="btn-check",
+                                    labelClassName="btn btn-outline-primary",
+                                    labelStyle={"margin-right": "10px"},
+                                    inline=True,
+                                ),
+                            ],
+                            style=heatmap_options_style(chart),
+                        ),
+                    ],
+                    style={"display": "flex", "justify-content": "space-between", "padding-top": "10px"},
+                ),
+                export_buttons("worldview", export_hrefs(start=start, end=end)),
 
                 # Container for the line graph and its text card
                 html.Div(
                     children=[
                         # Line graph (75% width)
                         html.Div(
-                            dcc.Graph(id="worldview-line-graph"),
+                            dcc.Graph(id="worldview-line-graph", figure=line_fig),
                             style={"width": "75%", "padding-right": "10px"},  #  padding-right
                         ),
                         
@@ -264,7 +612,7 @@ def update_mode_content(mode):
                                         children=[
                                             html.H4("Line Graph Description", className="card-title"),
                                             html.P(
-                                                "The line graph in the Worldview mode shows the trend of CO2 emissions per capita across time. You can use the year range slider to adjust the time frame and observe how emissions have changed globally.",
+                                                "The line graph in the Worldview mode shows the trend of CO2 emissions per capita across time. You can use the year range slider to adjust the time frame and observe how emissions have changed globally. Switch to the heatmap to see every country as one row, colored by its emissions in each year.",
                                                 className="card-text",
                                             ),
                                         ],
@@ -305,7 +653,7 @@ def update_mode_content(mode):
                         
                         # Histogram (75% width)
                         html.Div(
-                            dcc.Graph(id="worldview-histogram"),
+                            dcc.Graph(id="worldview-histogram", figure=histogram_fig),
                             style={"width": "75%", "padding-left": "10px"},  # 75% width with padding-left
                         ),
                     ],
@@ -321,6 +669,8 @@ def update_mode_content(mode):
             # Single Country mode
 
     elif mode == "single_country":
+        ahead = selection["ahead"]
+        line_fig, box_fig = single_country_figures(countries[0], start, end, int(ahead))
         content = html.Div(
             children=[
                 # Dropdown and year range slider
@@ -329,8 +679,8 @@ def update_mode_content(mode):
                         html.Div(
                             dcc.Dropdown(
                                 id="country-dropdown",
-                                options=[{"label": country, "value": country} for country in data["country"].unique()],
-                                value="USA",  # Default value
+                                options=country_options(countries),  # the rest comes from the search callback as the user types
+                                value=countries[0],  # USA by default
                             ),
                             style={"width": "50%", "padding-right": "10px"},  # 50% width with padding-right
                         ),
@@ -339,7 +689,7 @@ def update_mode_content(mode):
                                 id="year-slider",
                                 min=data["year"].min(),
                                 max=data["year"].max(),
-                                value=[data["year"].min(), data["year"].max()],
+                                value=[start, end],
                                 marks={str(year): str(year) for year in range(data["year"].min(), data["year"].max() + 1, 10)},
                                 step=1,
                             ),
@@ -348,6 +698,8 @@ def update_mode_content(mode):
                     ],
                     style={"display": "flex", "justify-content": "space-between", "align-items": "center"},
                 ),
+                forecast_selector("forecast-years", ahead),
+                export_buttons("single-country", country_export_hrefs(countries, start, end)),
 
                 # Container for the graphs and text description cards
                 html.Div(
@@ -355,7 +707,7 @@ def update_mode_content(mode):
                         # Line graph and its text card
                         html.Div(
                             children=[
-                                dcc.Graph(id="line-graph"),  # Line graph for single country
+                                dcc.Graph(id="line-graph", figure=line_fig),  # Line graph for single country
                                 html.Div(
                                     className="card border-primary mb-3",
                                     children=[
@@ -365,7 +717,7 @@ def update_mode_content(mode):
                                             children=[
                                                 html.H4("Line Graph Description", className="card-title"),
                                                 html.P(
-                                                    "The line graph in the Single Country mode demonstrates CO2 emissions per capita for a specific country over time. You can select a country from the dropdown and adjust the year range slider to observe changes in emissions",
+                                                    "The line graph in the Single Country mode demonstrates CO2 emissions per capita for a specific country over time. You can select a country from the dropdown and adjust the year range slider to observe changes in emissions. A projection extends the line with the trend of the last 30 years and its 95% confidence band.",
                                                     className="card-text",
                                                 ),
                                             ],
@@ -379,7 +731,7 @@ def update_mode_content(mode):
                         # Box plot and its text card
                         html.Div(
                             children=[
-                                dcc.Graph(id="box-plot"),  # Box plot for single country
+                                dcc.Graph(id="box-plot", figure=box_fig),  # Box plot for single country
                                 html.Div(
                                     className="card border-primary mb-3",
                                     children=[
@@ -415,6 +767,8 @@ def update_mode_content(mode):
 
             # Multiple Country mode
     elif mode == "multiple_country":
+        metric, ahead = selection["metric"], selection["ahead"]
+        line_fig, violin_fig = multi_country_figures(tuple(countries), start, end, metric, int(ahead))
         content = html.Div(
             children=[
                 # Dropdown and year range slider for multiple countries
@@ -424,8 +778,8 @@ def update_mode_content(mode):
                             dcc.Dropdown(
                                 id="multiple-country-dropdown",
                                 multi=True,
-                                options=[{"label": country, "value": country} for country in data["country"].unique()],
-                                value=["USA", "China"],  # Default selected values
+                                options=country_options(countries),  # the rest comes from the search callback as the user types
+                                value=countries,  # USA and China by default
                             ),
                             style={"width": "50%"},  # 50% width for the dropdown
                         ),
@@ -434,7 +788,7 @@ def update_mode_content(mode):
                                 id="multiple-year-slider",
                                 min=data["year"].min(),
                                 max=data["year"].max(),
-                                value=[data["year"].min(), data["year"].max()],
+                                value=[start, end],
                                 marks={str(year): str(year) for year in range(data["year"].min(), data["year"].max() + 1, 10)},
                                 step=1,
                             ),
@@ -443,6 +797,23 @@ def update_mode_content(mode):
                     ],
                     style={"display": "flex", "justify-content": "space-between", "align-items": "center"},
                 ),
+                # What to compare: the raw values, an index where each country's first nonzero year is 100, or yearly growth
+                dcc.RadioItems(
+                    id="comparison-metric",
+                    options=[
+                        {"label": "Per Capita", "value": "raw"},
+                        {"label": "Indexed (First Nonzero Year = 100)", "value": "indexed"},
+                        {"label": "Growth Per Year", "value": "growth"},
+                    ],
+                    value=metric,
+                    inputClassName="btn-check",
+                    labelClassName="btn btn-outline-primary",
+                    labelStyle={"margin-right": "10px"},
+                    inline=True,
+                    style={"padding-top": "10px"},
+                ),
+                forecast_selector("multiple-forecast-years", ahead),
+                export_buttons("multi-country", country_export_hrefs(countries, start, end)),
 
                 # Container for the graphs and text description cards
                 html.Div(
@@ -450,7 +821,7 @@ def update_mode_content(mode):
                         # Line graph for multiple countries and its text card
                         html.Div(
                             children=[
-                                dcc.Graph(id="multi-country-line-graph"),  # Line graph for multiple countries
+                                dcc.Graph(id="multi-country-line-graph", figure=line_fig),  # Line graph for multiple countries
                                 html.Div(
                                     className="card border-primary mb-3",
                                     children=[
@@ -474,7 +845,7 @@ def update_mode_content(mode):
                         # Violin graph for multiple countries and its text card
                         html.Div(
                             children=[
-                                dcc.Graph(id="multi-country-violin-graph"),  # Violin graph for multiple countries
+                                dcc.Graph(id="multi-country-violin-graph", figure=violin_fig),  # Violin graph for multiple countries
                                 html.Div(
                                     className="card border-primary mb-3",
                                     children=[
@@ -507,6 +878,7 @@ def update_mode_content(mode):
 
     # Year View mode
     elif mode == "year_view":
+        bar_fig = year_figure(end)
         content = html.Div(
             children=[
                 # Slider to select the year
@@ -514,17 +886,18 @@ def update_mode_content(mode):
                     id="single-year-slider",
                     min=data["year"].min(),
                     max=data["year"].max(),
-                    value=data["year"].max(),
+                    value=end,
                     marks={str(year): str(year) for year in range(data["year"].min(), data["year"].max() + 1, 10)},
                     step=1,
                 ),
+                export_buttons("year-view", export_hrefs(start=end, end=end)),
 
                 # Container for the bar graph and the description text card
                 html.Div(
                     children=[
                         # Bar graph taking 75% of the width
                         html.Div(
-                            dcc.Graph(id="year-bar-graph"),
+                            dcc.Graph(id="year-bar-graph", figure=bar_fig),
                             style={"width": "75%", "padding-right": "10px"},  # 75% width with padding-right
                         ),
 
@@ -556,34 +929,161 @@ def update_mode_content(mode):
             style={"padding": "20px"}, 
         )
 
-    # Returning here the mode description and content
-    return mode_description, content
+    return content
 
-# Callback for updating graphs in the Worldview mode
-@app.callback(
-    [Output("worldview-line-graph", "figure"),
-     Output("worldview-histogram", "figure")],
-    [Input("worldview-year-slider", "value")]
-)
-def update_worldview_graphs(year_range):
+# The figures of every mode are built by these cached functions, so a selection that was already
+# drawn once (including the defaults that every deep link and mode switch uses) skips plotly entirely.
+# The callbacks below just look the figures up
+
+
+def stored_size(stored):
+    return len(stored) if isinstance(stored, str) else sum(len(part) for part in stored)
+
+
+class FigureCache:
+    # Least recently used cache of the figure builders' results, kept as plotly JSON and bounded by its size in bytes.
+    # A Figure object takes a few times the memory of its JSON, and the JSON is what a hit sends anyway.
+    # Entries stored while pinning (the default selections) are never evicted, they only go with clear()
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.pinned = {}
+        self.size = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def pinning(self, enabled=True):
+        previous = getattr(self._local, "pinning", False)
+        self._local.pinning = enabled
+        try:
+            yield
+        finally:
+            self._local.pinning = previous
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.pinned.clear()
+            self.size = 0
+
+    def _drop(self, key):
+        stored = self.entries.pop(key, None)
+        if stored is not None:
+            self.size -= stored_size(stored)
+
+    def cached(self, build):
+        def lookup(*args):
+            key = (build.__name__,) + args
+            pin = getattr(self._local, "pinning", False)
+            with self._lock:
+                stored = self.pinned.get(key)
+                if stored is None and key in self.entries:
+                    stored = self.entries[key]
+                    if pin:
+                        self._drop(key)
+                        self.pinned[key] = stored
+                    else:
+                        self.entries.move_to_end(key)
+            if stored is not None:
+                return json.loads(stored) if isinstance(stored, str) else tuple(json.loads(part) for part in stored)
+
+            result = build(*args)
+            stored = result.to_json() if isinstance(result, go.Figure) else tuple(fig.to_json() for fig in result)
+            with self._lock:
+                if pin:
+                    self.pinned[key] = stored
+                else:
+                    self._drop(key)
+                    self.entries[key] = stored
+                    self.size += stored_size(stored)
+                    while self.size > self.max_bytes and self.entries:
+                        self._drop(next(iter(self.entries)))
+            return result
+
+        lookup.__name__ = build.__name__
+        return lookup
+
+
+figure_cache = FigureCache(FIGURE_CACHE_MB * 2 ** 20)
+
+def heatmap_row_order(values, order, countries):
+    # Positions of the matrix rows from the bottom of the heatmap to the top
+    if order == "cluster":
+        # Hierarchical clustering on the log values, the dendrogram leaf order puts similar countries next to each other
+        features = np.log1p(np.nan_to_num(np.clip(values, 0, None)))
+        return leaves_list(linkage(features, method="ward")) if len(features) > 1 else np.arange(len(features))
+    if order == "name":
+        return np.argsort(countries.to_numpy())[::-1]
+    # Biggest emitters over the range on top
+    return np.argsort(np.nansum(values, axis=1))
+
+
+def worldview_heatmap(start, end, order="total", scale="linear"):
+    # The whole country x year matrix as one heatmap trace, cropping the range is just a column slice
+    matrix = co2_matrix.loc[:, start:end]
+    values = matrix.to_numpy(dtype=float, copy=True)
+    rows = heatmap_row_order(values, order, matrix.index)
+    values = values[rows]
+
+    colorbar = {"title": "CO2 Per Capita"}
+    hovertemplate = "%{y}, %{x}<br>CO2 Per Capita: %{z}<extra></extra>"
+    customdata = None
+    if scale == "log":
+        # Plotly heatmaps have no log color axis, so I color by log10 and label the colorbar with the real values.
+        # The real values also go along as customdata, so hovering shows them instead of the logs
+        customdata = values.astype(np.float32)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            values = np.log10(np.where(values > 0, values, np.nan))
+        if np.isfinite(values).any():
+            ticks = np.arange(np.floor(np.nanmin(values)), np.ceil(np.nanmax(values)) + 1)
+            colorbar.update(tickvals=ticks, ticktext=[f"{10 ** tick:g}" for tick in ticks])
+        hovertemplate = "%{y}, %{x}<br>CO2 Per Capita: %{customdata:.4~g}<extra></extra>"
+
+    heatmap_fig = go.Figure(
+        go.Heatmap(
+            z=values.astype(np.float32),  # float32 is plenty for colors and halves the payload
+            x=matrix.columns,
+            y=matrix.index[rows],
+            customdata=customdata,
+            colorscale="Reds",
+            colorbar=colorbar,
+            hovertemplate=hovertemplate,
+        )
+    )
+    heatmap_fig.update_layout(
+        title="Global CO2 Emissions Per Capita Over Time",
+        xaxis_title="Year",
+        yaxis={"title": "Country", "tickfont": {"size": 8}},
+        height=max(500, 5 * len(rows)),
+    )
+    return heatmap_fig
+
+
+# Building the figures for the Worldview mode
+@figure_cache.cached
+def worldview_figures(start, end, chart="lines", order="total", scale="linear"):
     # First I ma filtering the data based on the selected year rang
     filtered_data = data[
-        (data["year"] >= year_range[0]) &
-        (data["year"] <= year_range[1])
+        (data["year"] >= start) &
+        (data["year"] <= end)
     ]
 
-    # I am creating a line graph showing CO2 emissions
-    line_fig = px.line(
-        filtered_data,
-        x="year",
-        y="co2_per_capita",
-        color="country",
-        title="Global CO2 Emissions Per Capita Over Time",
-    )
-    line_fig.update_layout(
-        xaxis_title="Year",  # Renaming 
-        yaxis_title="CO2 Per Capita",  # Renaming
-    )
+    if chart == "heatmap":
+        line_fig = worldview_heatmap(start, end, order, scale)
+    else:
+        # I am creating a line graph showing CO2 emissions
+        line_fig = px.line(
+            filtered_data,
+            x="year",
+            y="co2_per_capita",
+            color="country",
+            title="Global CO2 Emissions Per Capita Over Time",
+        )
+        line_fig.update_layout(
+            xaxis_title="Year",  # Renaming 
+            yaxis_title="CO2 Per Capita",  # Renaming
+        )
 # Creating a histogram showing the distribution of CO2 emissions per capita
     histogram_fig = px.histogram(
         filtered_data,
@@ -599,20 +1099,47 @@ def update_worldview_graphs(year_range):
     return line_fig, histogram_fig
 
 
+def add_forecast_traces(fig, selected_countries, end, ahead):
+    # Dashed projection with its confidence band for each country, straight out of the fitted forecasts.
+    # Only drawn when the graph runs up to the latest year, otherwise the projection would float after a gap
+    if not ahead or end < co2_matrix.columns.max():
+        return fig
+    colors = {trace.name: trace.line.color for trace in fig.data}
+    for country in selected_countries:
+        if country not in forecasts["mean"].index:
+            continue
+        years = forecasts["mean"].columns[:ahead]
+        mean, lower, upper = (forecasts[key].loc[country].iloc[:ahead].to_numpy() for key in ("mean", "lower", "upper"))
+        color = colors.get(country) or colors.get("") or "#636efa"
+        fig.add_trace(go.Scatter(
+            x=np.concatenate([years, years[::-1]]),
+            y=np.concatenate([upper, lower[::-1]]),
+            fill="toself",
+            fillcolor=color,
+            opacity=0.2,
+            line={"width": 0},
+            hoverinfo="skip",
+            showlegend=False,
+        ))
+        fig.add_trace(go.Scatter(
+            x=years,
+            y=mean,
+            mode="lines",
+            line={"color": color, "dash": "dash"},
+            name=f"{country} (projected)",
+            showlegend=len(selected_countries) > 1,
+        ))
+    return fig
 
-# Callback to update graphs for the Single Country View
-@app.callback(
-    [Output("line-graph", "figure"),
-     Output("box-plot", "figure")],
-    [Input("country-dropdown", "value"),
-     Input("year-slider", "value")]
-)
-def update_single_country_graphs(selected_country, year_range):
+
+# Building the figures for the Single Country View
+@figure_cache.cached
+def single_country_figures(selected_country, start, end, ahead=0):
     # this was difficult because I keep getting errors but what works is
     #I am first filtering the data based on the selected country and year range
     filtered_data = data[(data['country'] == selected_country) &
-                         (data['year'] >= year_range[0]) &
-                         (data['year'] <= year_range[1])]
+                         (data['year'] >= start) &
+                         (data['year'] <= end)]
     
     # Then I am obviously creating the line graph with the filtered data
     line_fig = px.line(
@@ -628,6 +1155,7 @@ def update_single_country_graphs(selected_country, year_range):
         margin={'l': 40, 'b': 40, 't': 40, 'r': 20},  # This is just some extra code to adjust margins to avoid cutoff
         height=400  # Just makiing sure the height matches box plot
     )
+    add_forecast_traces(line_fig, [selected_country], end, ahead)
 
     # I will not create the box plot with my filtered data
     box_fig = px.box(
@@ -645,53 +1173,140 @@ def update_single_country_graphs(selected_country, year_range):
     # Now, finally I am returniong both figures
     return line_fig, box_fig
 
+
+def compare_countries(selected_countries, start, end, metric="raw"):
+    # I take one slice of the country x year matrix for all the selected countries and compute the metric
+    # on the whole array at once, instead of filtering and transforming country by country
+    sliced = co2_matrix.reindex(index=list(selected_countries)).loc[:, start:end]
+    values = sliced.to_numpy(dtype=float, copy=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if metric == "indexed":
+            # Each country is indexed to its own first positive value in the range, a lot of countries
+            # are 0 or missing in the early years and dividing by that would wipe out the whole row
+            positive = values > 0
+            base = values[np.arange(len(values)), positive.argmax(axis=1)]
+            base[~positive.any(axis=1)] = np.nan
+            values = values / base[:, None] * 100
+        elif metric == "growth":
+            growth = (values[:, 1:] / values[:, :-1] - 1) * 100
+            values = np.hstack([np.full((len(values), 1), np.nan), growth])
+    # Dividing by a zero (a growth from 0, or a country with nothing positive to index to) gives inf, those become gaps
+    values[~np.isfinite(values)] = np.nan
+    return pd.DataFrame(values, index=sliced.index, columns=sliced.columns)
+
+
+# How many countries the note about countries without data names before it just counts the rest
+MISSING_NOTE_LIMIT = 8
+
+
+def note_missing_countries(fig, compared):
+    # Countries with nothing to draw in the range would just be absent from the graph, so they get named in a note.
+    # Names like "Congo, Dem. Rep." have commas in them, so the list is separated with semicolons
+    missing = list(compared.index[compared.isna().all(axis=1)])
+    if missing:
+        text = "; ".join(missing[:MISSING_NOTE_LIMIT])
+        if len(missing) > MISSING_NOTE_LIMIT:
+            text += f" and {len(missing) - MISSING_NOTE_LIMIT} more"
+        fig.add_annotation(
+            text="No data to show for: " + text,
+            xref="paper", yref="paper", x=0, y=1.02,
+            xanchor="left", yanchor="bottom", showarrow=False,
+            font={"size": 11, "color": "gray"},
+        )
+    return fig
+
+
 #now basically I did the same thing for multi country as single country view, except now for multiple countries
+# (the countries come in as a tuple so they can be part of the cache key)
+@figure_cache.cached
+def multi_country_figures(selected_countries, start, end, metric="raw", ahead=0):
+    compared = compare_countries(selected_countries, start, end, metric)
+    axis_title = comparison_metrics[metric]
+    # Long format for plotly express, gaps are dropped like they were when filtering the rows
+    filtered_data = compared.stack().dropna().rename("value").reset_index()
 
-@app.callback(
-    [Output("multi-country-line-graph", "figure"),
-     Output("multi-country-violin-graph", "figure")],
-    [Input("multiple-country-dropdown", "value"),
-     Input("multiple-year-slider", "value")]
-)
-def update_multi_country_graphs(selected_countries, year_range):
-    filtered_data = data[
-        (data["country"].isin(selected_countries)) &
-        (data["year"] >= year_range[0]) &
-        (data["year"] <= year_range[1])
-    ]
-    
-    line_fig = px.line(
-        filtered_data,
-        x="year",
-        y="co2_per_capita",
-        color="country",
-        title="CO2 Emissions Per Capita Over Time for Selected Countries",
-    )
-    line_fig.update_layout(
-        xaxis_title="Year",  
-        yaxis_title="CO2 Per Capita",  
-    )
+    if len(selected_countries) <= COMPARISON_LINE_LIMIT:
+        line_fig = px.line(
+            filtered_data,
+            x="year",
+            y="value",
+            color="country",
+            title="CO2 Emissions Per Capita Over Time for Selected Countries",
+        )
+        line_fig.update_layout(
+            xaxis_title="Year",  
+            yaxis_title=axis_title,  
+        )
+        # Projections are in CO2 per capita, so they only go on the graph of the raw values
+        if metric == "raw":
+            add_forecast_traces(line_fig, selected_countries, end, ahead)
 
-    violin_fig = px.violin(
-        filtered_data,
-        y="co2_per_capita",
-        color="country",
-        box=True,
-        title="Distribution of CO2 Emissions Per Capita for Selected Countries",
+        violin_fig = px.violin(
+            filtered_data,
+            y="value",
+            color="country",
+            box=True,
+            title="Distribution of CO2 Emissions Per Capita for Selected Countries",
+        )
+        violin_fig.update_layout(
+            yaxis_title=axis_title,  
+        )
+        return note_missing_countries(line_fig, compared), violin_fig
+
+    # Too many countries for one line graph, so small multiples (one little graph per country)
+    # or, for really big selections, a heatmap with one row per country
+    if len(selected_countries) <= COMPARISON_SMALL_MULTIPLES_LIMIT:
+        rows = -(-len(selected_countries) // 5)
+        line_fig = px.line(
+            filtered_data,
+            x="year",
+            y="value",
+            facet_col="country",
+            facet_col_wrap=5,
+            # plotly refuses a spacing above 1 / (rows - 1), which a raised COMPARISON_SMALL_MULTIPLES_LIMIT can reach
+            facet_row_spacing=min(0.04, 1 / max(rows - 1, 1)),
+            height=160 * rows,
+            title="CO2 Emissions Per Capita Over Time for Selected Countries",
+        )
+        line_fig.for_each_annotation(lambda annotation: annotation.update(text=annotation.text.split("=")[-1]))
+        line_fig.update_yaxes(title_text="")
+        line_fig.update_xaxes(title_text="")
+    else:
+        line_fig = go.Figure(
+            go.Heatmap(
+                z=compared.to_numpy(dtype=np.float32),  # float32 like the worldview heatmap, half the payload
+                x=compared.columns,
+                y=compared.index,
+                colorscale="Reds",
+                colorbar={"title": axis_title},
+            )
+        )
+        line_fig.update_layout(
+            title="CO2 Emissions Per Capita Over Time for Selected Countries",
+            xaxis_title="Year",
+            height=max(400, 14 * len(selected_countries)),
+        )
+
+    # And instead of a violin per country, one bar per country with its average over the range
+    averages = compared.mean(axis=1).sort_values()
+    violin_fig = px.bar(
+        x=averages.to_numpy(),
+        y=averages.index,
+        orientation="h",
+        height=max(400, 14 * len(selected_countries)),
+        title="Average CO2 Emissions Per Capita for Selected Countries",
     )
     violin_fig.update_layout(
-        yaxis_title="CO2 Per Capita",  
+        xaxis_title=axis_title,
+        yaxis_title="Country",
     )
 
-    return line_fig, violin_fig
+    return note_missing_countries(line_fig, compared), violin_fig
 
 
 #this is for year view
-@app.callback(
-    Output("year-bar-graph", "figure"),
-    [Input("single-year-slider", "value")]
-)
-def update_year_graph(selected_year):
+@figure_cache.cached
+def year_figure(selected_year):
     # First going to filter the data to get records for the selected year
     filtered_data = data[
         (data["year"] == selected_year)
@@ -713,6 +1328,291 @@ def update_year_graph(selected_year):
     return bar_fig
 
 
+# Callback for updating graphs in the Worldview mode
+@app.callback(
+    [Output("worldview-line-graph", "figure"),
+     Output("worldview-histogram", "figure")],
+    [Input("worldview-year-slider", "value"),
+     Input("worldview-chart", "value"),
+     Input("heatmap-order", "value"),
+     Input("heatmap-scale", "value")],
+    prevent_initial_call=True,
+)
+def update_worldview_graphs(year_range, chart, order, scale):
+    return worldview_figures(year_range[0], year_range[1], *worldview_options(chart, order, scale))
+
+
+@app.callback(
+    Output("heatmap-options", "style"),
+    [Input("worldview-chart", "value")],
+    prevent_initial_call=True,
+)
+def toggle_heatmap_options(chart):
+    return heatmap_options_style(chart)
+
+
+# Callback to update graphs for the Single Country View
+@app.callback(
+    [Output("line-graph", "figure"),
+     Output("box-plot", "figure")],
+    [Input("country-dropdown", "value"),
+     Input("year-slider", "value"),
+     Input("forecast-years", "value")],
+    prevent_initial_call=True,
+)
+def update_single_country_graphs(selected_country, year_range, ahead):
+    return single_country_figures(selected_country, year_range[0], year_range[1], int(ahead))
+
+
+@app.callback(
+    [Output("multi-country-line-graph", "figure"),
+     Output("multi-country-violin-graph", "figure")],
+    [Input("multiple-country-dropdown", "value"),
+     Input("multiple-year-slider", "value"),
+     Input("comparison-metric", "value"),
+     Input("multiple-forecast-years", "value")],
+    prevent_initial_call=True,
+)
+def update_multi_country_graphs(selected_countries, year_range, metric, ahead):
+    return multi_country_figures(tuple(selected_countries or []), year_range[0], year_range[1], metric, int(ahead))
+
+
+@app.callback(
+    Output("year-bar-graph", "figure"),
+    [Input("single-year-slider", "value")],
+    prevent_initial_call=True,
+)
+def update_year_graph(selected_year):
+    return year_figure(selected_year)
+
+
+# Callbacks that keep the page URL and each mode's download buttons in line with the current selection.
+# They also fire when a mode's controls get swapped in, which is what writes the new mode into the URL.
+# shown-search gets the same string, that is how update_mode_content tells these writes apart from Back/Forward
+@app.callback(
+    [Output("url", "search", allow_duplicate=True),
+     Output("shown-search", "data", allow_duplicate=True),
+     Output("worldview-export-csv", "href"),
+     Output("worldview-export-parquet", "href")],
+    [Input("worldview-year-slider", "value"),
+     Input("worldview-chart", "value"),
+     Input("heatmap-order", "value"),
+     Input("heatmap-scale", "value")],
+    prevent_initial_call=True,
+)
+def sync_worldview_selection(year_range, chart, order, scale):
+    chart, order, scale = worldview_options(chart, order, scale)
+    options = {"chart": chart, "order": order, "scale": scale}
+    search = selection_search("worldview", start=year_range[0], end=year_range[1], options=options)
+    return search, search, *export_hrefs(start=year_range[0], end=year_range[1])
+
+
+@app.callback(
+    [Output("url", "search", allow_duplicate=True),
+     Output("shown-search", "data", allow_duplicate=True),
+     Output("single-country-export-csv", "href"),
+     Output("single-country-export-parquet", "href")],
+    [Input("country-dropdown", "value"),
+     Input("year-slider", "value"),
+     Input("forecast-years", "value")],
+    prevent_initial_call=True,
+)
+def sync_single_country_selection(selected_country, year_range, ahead):
+    countries = [selected_country] if selected_country else []
+    search = selection_search("single_country", countries, year_range[0], year_range[1], {"ahead": ahead})
+    return search, search, *country_export_hrefs(countries, year_range[0], year_range[1])
+
+
+@app.callback(
+    [Output("url", "search", allow_duplicate=True),
+     Output("shown-search", "data", allow_duplicate=True),
+     Output("multi-country-export-csv", "href"),
+     Output("multi-country-export-parquet", "href")],
+    [Input("multiple-country-dropdown", "value"),
+     Input("multiple-year-slider", "value"),
+     Input("comparison-metric", "value"),
+     Input("multiple-forecast-years", "value")],
+    prevent_initial_call=True,
+)
+def sync_multi_country_selection(selected_countries, year_range, metric, ahead):
+    options = {"metric": metric, "ahead": ahead}
+    search = selection_search("multiple_country", selected_countries, year_range[0], year_range[1], options)
+    return search, search, *country_export_hrefs(selected_countries, year_range[0], year_range[1])
+
+
+@app.callback(
+    [Output("url", "search", allow_duplicate=True),
+     Output("shown-search", "data", allow_duplicate=True),
+     Output("year-view-export-csv", "href"),
+     Output("year-view-export-parquet", "href")],
+    [Input("single-year-slider", "value")],
+    prevent_initial_call=True,
+)
+def sync_year_view_selection(selected_year):
+    search = selection_search("year_view", start=selected_year, end=selected_year)
+    return search, search, *export_hrefs(start=selected_year, end=selected_year)
+
+
+def iter_selection_chunks(countries, start, end):
+    # Walking the data in fixed size row chunks and only keeping the selected rows of each chunk,
+    # this way I never build a copy of the whole selection in memory.
+    # Holding on to the table keeps a download consistent even if the dataset is reloaded halfway through it
+    table = data
+    for offset in range(0, len(table), EXPORT_CHUNK_ROWS):
+        chunk = table.iloc[offset:offset + EXPORT_CHUNK_ROWS]
+        mask = (chunk["year"] >= start) & (chunk["year"] <= end)
+        if countries:
+            mask &= chunk["country"].isin(countries)
+        if mask.any():
+            yield chunk[mask]
+
+
+def stream_csv(chunks):
+    yield ",".join(data.columns) + "\n"
+    for chunk in chunks:
+        yield chunk.to_csv(index=False, header=False)
+
+
+class _ParquetChunkSink(io.RawIOBase):
+    # Tiny file object for the Parquet writer that hands back whatever was written since the last drain
+    def __init__(self):
+        super().__init__()
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._parts.append(bytes(b))
+        self._position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        out = b"".join(self._parts)
+        self._parts = []
+        return out
+
+
+def stream_parquet(chunks):
+    # Every chunk becomes its own row group, and its bytes are sent as soon as it is written
+    schema = pa.schema([
+        ("country", pa.string()),
+        ("year", pa.int64()),
+        ("co2_per_capita", pa.float64()),
+        ("interpolated", pa.bool_()),
+    ])
+    sink = _ParquetChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    for chunk in chunks:
+        writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+# The country dropdowns only hold the selected countries, every keystroke asks the search index for the top matches
+# instead of sending the full country list to each client
+def search_country_options(search_value, selected_countries):
+    if not search_value:
+        raise PreventUpdate
+    matches = country_index.search(search_value, COUNTRY_SEARCH_LIMIT)
+    kept = [country for country in selected_countries if country not in matches]
+    return country_options(matches, search_value) + country_options(kept)
+
+
+@app.callback(
+    Output("country-dropdown", "options"),
+    [Input("country-dropdown", "search_value")],
+    [State("country-dropdown", "value")],
+    prevent_initial_call=True,
+)
+def search_single_country(search_value, selected_country):
+    return search_country_options(search_value, [selected_country] if selected_country else [])
+
+
+@app.callback(
+    Output("multiple-country-dropdown", "options"),
+    [Input("multiple-country-dropdown", "search_value")],
+    [State("multiple-country-dropdown", "value")],
+    prevent_initial_call=True,
+)
+def search_multiple_countries(search_value, selected_countries):
+    return search_country_options(search_value, selected_countries or [])
+
+
+# Same search as a plain endpoint, e.g. /search/countries?q=united%20states
+@server.route("/search/countries")
+def search_countries():
+    query = request.args.get("q", "")
+    limit = max(1, min(request.args.get("limit", COUNTRY_SEARCH_LIMIT, type=int), 100))
+    return jsonify({"query": query, "matches": country_index.search(query, limit)})
+
+
+# Export endpoint that streams the selected rows as CSV or Parquet
+@server.route("/export/<fmt>")
+def export_selection(fmt):
+    countries = request.args.getlist("country")
+    start = request.args.get("start", data["year"].min(), type=int)
+    end = request.args.get("end", data["year"].max(), type=int)
+    chunks = iter_selection_chunks(countries, start, end)
+
+    if fmt == "csv":
+        body, mimetype = stream_csv(chunks), "text/csv"
+    elif fmt == "parquet":
+        if pq is None:
+            abort(501, "Parquet export needs pyarrow to be installed")
+        body, mimetype = stream_parquet(chunks), "application/vnd.apache.parquet"
+    else:
+        abort(404)
+
+    return Response(
+        body,
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename=co2_per_capita.{fmt}"},
+    )
+
+
+def on_dataset_change():
+    # Everything derived from the old data has to go, the figure cache is keyed by selection only
+    figure_cache.clear()
+
+
+# Picking up a new csv without a restart, the file is only looked at every DATASET_CHECK_SECONDS
+@server.before_request
+def refresh_dataset():
+    if time.time() - dataset_state["checked"] < DATASET_CHECK_SECONDS:
+        return
+    dataset_state["checked"] = time.time()
+    stat = os.stat(DATA_PATH)
+    if (stat.st_mtime_ns, stat.st_size) == dataset_state["stat"]:
+        return
+    try:
+        changed = load_dataset()
+    except Exception:
+        # A broken csv must not turn requests into 500s, the current version keeps being served.
+        # Its stat is remembered so the same file is not tried again until it changes
+        logger.exception("Could not load %s, still serving dataset %s", DATA_PATH, dataset_state["version"])
+        dataset_state["stat"] = (stat.st_mtime_ns, stat.st_size)
+        return
+    if changed:
+        on_dataset_change()
+
+
+# Validation report of the dataset currently being served
+@server.route("/dataset/report")
+def dataset_report():
+    return jsonify(data_report)
+
+
+# Opt-in sampling profiler, nothing of it is loaded or hooked in unless PROFILER_TOKEN is set
+if os.environ.get("PROFILER_TOKEN"):
+    from profiler import install_profiler
+
+    install_profiler(app, os.environ["PROFILER_TOKEN"], os.environ.get("PROFILER_DIR", "profiles"))
 
 # Start the server
 if __name__== '__main__':
@@ -0,0 +1,103 @@
+#Fuzzy search over country names for the country dropdowns
+#The index is built once per dataset version. Every name and alias is split into character trigrams and
+#each trigram keeps the array of names it appears in, so a query only touches the names sharing a trigram
+#with it and scoring is a bincount over those arrays. That stays fast for entity lists much longer than 194 countries.
+import unicodedata
+from collections import defaultdict
+
+import numpy as np
+
+# Other names people type for the countries in the dataset
+COUNTRY_ALIASES = {
+    "USA": ["United States", "United States of America", "US", "America"],
+    "UK": ["United Kingdom", "Great Britain", "Britain", "England"],
+    "UAE": ["United Arab Emirates", "Emirates"],
+    "South Korea": ["Korea, Rep.", "Republic of Korea", "Korea"],
+    "North Korea": ["Korea, Dem. Rep.", "DPRK"],
+    "Russia": ["Russian Federation"],
+    "Czech Republic": ["Czechia"],
+    "Slovak Republic": ["Slovakia"],
+    "Kyrgyz Republic": ["Kyrgyzstan"],
+    "Lao": ["Laos", "Lao PDR"],
+    "Congo, Dem. Rep.": ["DR Congo", "DRC", "Democratic Republic of the Congo"],
+    "Congo, Rep.": ["Republic of the Congo", "Congo-Brazzaville"],
+    "Cote d'Ivoire": ["Ivory Coast"],
+    "Cape Verde": ["Cabo Verde"],
+    "Eswatini": ["Swaziland"],
+    "Micronesia, Fed. Sts.": ["Micronesia"],
+    "Myanmar": ["Burma"],
+    "North Macedonia": ["Macedonia"],
+    "Timor-Leste": ["East Timor"],
+    "Turkey": ["Turkiye"],
+    "Hong Kong, China": ["Hong Kong"],
+    "Vietnam": ["Viet Nam"],
+    "Syria": ["Syrian Arab Republic"],
+    "Egypt": ["Egypt, Arab Rep."],
+    "Iran": ["Iran, Islamic Rep."],
+    "Yemen": ["Yemen, Rep."],
+    "Gambia": ["The Gambia"],
+    "Bahamas": ["The Bahamas"],
+    "Netherlands": ["Holland"],
+    "Palestine": ["West Bank and Gaza"],
+    "St. Kitts and Nevis": ["Saint Kitts and Nevis"],
+    "St. Lucia": ["Saint Lucia"],
+    "St. Vincent and the Grenadines": ["Saint Vincent and the Grenadines"],
+}
+
+
+def normalize(text):
+    # Lowercase, accents dropped and anything that is not a letter or digit turned into a single space
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode().lower()
+    return " ".join("".join(c if c.isalnum() else " " for c in text).split())
+
+
+def trigrams(text):
+    # Padded so that the start of a word counts, which is what makes short prefixes like "us" match
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class CountrySearchIndex:
+    def __init__(self, entities, aliases=COUNTRY_ALIASES):
+        self.entities = list(entities)
+        names, owners = [], []
+        for position, entity in enumerate(self.entities):
+            for name in [entity] + aliases.get(entity, []):
+                names.append(normalize(name))
+                owners.append(position)
+        self.names = np.array(names)
+        self.owners = np.array(owners)
+
+        postings = defaultdict(list)
+        sizes = []
+        for position, name in enumerate(names):
+            grams = trigrams(name)
+            sizes.append(len(grams))
+            for gram in grams:
+                postings[gram].append(position)
+        self.postings = {gram: np.array(positions) for gram, positions in postings.items()}
+        self.sizes = np.array(sizes)
+
+    def search(self, query, limit=10):
+        # Best matching entities first: trigram overlap (Jaccard) with a bonus for prefix and exact matches
+        query = normalize(query)
+        if not query or not self.entities:
+            return []
+        grams = trigrams(query)
+        hits = [self.postings[gram] for gram in grams if gram in self.postings]
+        if not hits:
+            return []
+        shared = np.bincount(np.concatenate(hits), minlength=len(self.names))
+        candidates = np.flatnonzero(shared)
+        scores = shared[candidates] / (len(grams) + self.sizes[candidates] - shared[candidates])
+        scores += np.char.startswith(self.names[candidates], query)
+        scores += self.names[candidates] == query
+
+        # An entity scores as well as its best name, then the top few are picked without sorting everything
+        best = np.zeros(len(self.entities))
+        np.maximum.at(best, self.owners[candidates], scores)
+        matched = np.flatnonzero(best)
+        if len(matched) > limit:
+            matched = matched[np.argpartition(-best[matched], limit)[:limit]]
+        top = matched[np.argsort(-best[matched], kind="stable")]
+        return [self.entities[position] for position in top]
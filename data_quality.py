@@ -0,0 +1,92 @@
+#Validation and gap filling for the CO2 per capita dataset
+#This runs once per dataset version when app.py loads or reloads the csv, never inside a callback.
+#Everything works on whole columns or on the country x year matrix at once:
+#   - values that are not numbers, and rows without a usable country or year
+#   - duplicate (country, year) pairs, which get averaged into one value
+#   - gaps, meaning missing years between a country's first and last recorded year
+#   - outliers, meaning values more than OUTLIER_RATIO times off the median of the years around them
+#Gaps can optionally be filled by linear interpolation, those rows get interpolated=True.
+import numpy as np
+import pandas as pd
+
+# How far (as a ratio) a value has to be from its 5 year neighborhood median to count as an outlier
+OUTLIER_RATIO = 3
+
+# How many examples of each problem go into the report
+REPORT_EXAMPLES = 10
+
+
+def validate_dataset(raw, interpolate=False, outlier_ratio=OUTLIER_RATIO):
+    # Returns the cleaned long data, the country x year matrix and a report of what was found
+    report = {"rows": len(raw)}
+
+    country = raw["country"].astype("string").str.strip()
+    year = pd.to_numeric(raw["year"], errors="coerce")
+    value = pd.to_numeric(raw["co2_per_capita"], errors="coerce")
+
+    report["missing_values"] = int(raw["co2_per_capita"].isna().sum())
+    report["non_numeric_values"] = int((value.isna() & raw["co2_per_capita"].notna()).sum())
+    invalid = country.isna() | (country == "") | year.isna() | (year % 1 != 0)
+    report["invalid_rows"] = int(invalid.sum())
+
+    frame = pd.DataFrame({"country": country, "year": year, "co2_per_capita": value})[~invalid]
+    frame["year"] = frame["year"].astype(int)
+
+    duplicated = frame.duplicated(["country", "year"], keep=False)
+    report["duplicates"] = int(frame.duplicated(["country", "year"]).sum())
+    report["duplicate_examples"] = (
+        frame.loc[duplicated, ["country", "year"]].drop_duplicates().head(REPORT_EXAMPLES).values.tolist()
+    )
+
+    # Duplicates are averaged, then every year between the first and the last one gets a column
+    matrix = frame.groupby(["country", "year"])["co2_per_capita"].mean().unstack("year")
+    if len(matrix.columns):
+        matrix = matrix.reindex(columns=range(matrix.columns.min(), matrix.columns.max() + 1))
+    matrix.columns.name = "year"
+
+    # A gap is a missing year after a country's first value and before its last one
+    observed = matrix.notna()
+    after_first = observed.cummax(axis=1)
+    before_last = observed.iloc[:, ::-1].cummax(axis=1).iloc[:, ::-1]
+    gaps = ~observed & after_first & before_last
+    gaps_per_country = gaps.sum(axis=1)
+    report["gaps"] = int(gaps_per_country.sum())
+    report["gap_examples"] = [
+        [name, int(count)] for name, count in gaps_per_country[gaps_per_country > 0].nlargest(REPORT_EXAMPLES).items()
+    ]
+
+    # Outliers are judged on log values, so a jump from 0.01 to 0.1 counts as much as one from 1 to 10
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_values = np.log10(matrix.where(matrix > 0))
+    neighborhood = log_values.T.rolling(5, center=True, min_periods=3).median().T
+    outliers = (log_values - neighborhood).abs() > np.log10(outlier_ratio)
+    flagged = matrix.where(outliers).stack().dropna()
+    report["outliers"] = len(flagged)
+    report["outlier_examples"] = [
+        [name, int(when), float(amount)] for (name, when), amount in flagged.head(REPORT_EXAMPLES).items()
+    ]
+    report["outlier_ratio"] = outlier_ratio
+
+    if interpolate:
+        matrix = matrix.interpolate(axis=1, limit_area="inside")
+    report["interpolated"] = report["gaps"] if interpolate else 0
+
+    long = pd.DataFrame({"co2_per_capita": matrix.stack(), "interpolated": (gaps & interpolate).stack()})
+    long = long.dropna(subset=["co2_per_capita"]).reset_index()
+    long = long.sort_values(["year", "country"], ignore_index=True)
+    long = long[["country", "year", "co2_per_capita", "interpolated"]]
+    report["clean_rows"] = len(long)
+    return long, matrix, report
+
+
+def summarize_report(report):
+    # One line per problem for the log
+    lines = [
+        f"{report['rows']} rows read, {report['clean_rows']} rows after cleaning",
+        f"{report['invalid_rows']} rows without a usable country or year",
+        f"{report['missing_values']} missing and {report['non_numeric_values']} non-numeric values",
+        f"{report['duplicates']} duplicate (country, year) rows averaged, e.g. {report['duplicate_examples']}",
+        f"{report['gaps']} missing years inside a country's range, {report['interpolated']} interpolated, e.g. {report['gap_examples']}",
+        f"{report['outliers']} values more than {report['outlier_ratio']}x off their neighbors, e.g. {report['outlier_examples']}",
+    ]
+    return "\n".join(lines)
@@ -0,0 +1,48 @@
+#Projections of CO2 per capita for every country
+#All countries are fitted together in one scikit-learn call: a LinearRegression with one output column
+#per country over the last FORECAST_WINDOW years of the country x year matrix. app.py runs this once per
+#dataset version when the data is loaded, so the callbacks only ever look projections up.
+import numpy as np
+import pandas as pd
+from scipy import stats
+from sklearn.linear_model import LinearRegression
+
+# How many of the most recent years the trend is fitted on
+FORECAST_WINDOW = 30
+
+# How many years ahead projections are computed (the dashboard shows up to this many)
+FORECAST_MAX_YEARS = 30
+
+# Width of the band around a projection
+CONFIDENCE = 0.95
+
+
+def fit_forecasts(matrix, window=FORECAST_WINDOW, max_years=FORECAST_MAX_YEARS, confidence=CONFIDENCE):
+    # Returns {"mean", "lower", "upper"}, each a country x future year DataFrame
+    recent = matrix.iloc[:, -window:]
+    # A few missing years inside the window are bridged, countries with nothing recent are left out
+    recent = recent.interpolate(axis=1, limit_direction="both").dropna()
+    years = recent.columns.to_numpy(dtype=float)
+    # Checked before anything looks at the last year, a header-only csv gives a matrix without any year columns
+    if len(recent) == 0 or len(years) < 3:
+        empty = pd.DataFrame(index=pd.Index([], name="country"), columns=pd.Index([], dtype=int), dtype=float)
+        return {"mean": empty, "lower": empty, "upper": empty}
+    future = np.arange(years[-1] + 1, years[-1] + max_years + 1)
+
+    # Rows are years and columns are countries, so this is one fit for every country at once
+    targets = recent.to_numpy(dtype=float).T
+    model = LinearRegression().fit(years.reshape(-1, 1), targets)
+    residuals = targets - model.predict(years.reshape(-1, 1))
+
+    # Prediction interval of a simple linear regression, worked out for all countries together
+    n = len(years)
+    spread = np.sqrt((residuals ** 2).sum(axis=0) / (n - 2))
+    leverage = 1 + 1 / n + (future - years.mean()) ** 2 / ((years - years.mean()) ** 2).sum()
+    margin = stats.t.ppf((1 + confidence) / 2, n - 2) * spread[:, None] * np.sqrt(leverage)[None, :]
+    mean = model.predict(future.reshape(-1, 1)).T
+
+    def frame(values):
+        # Emissions per capita can not go below zero
+        return pd.DataFrame(np.clip(values, 0, None), index=recent.index, columns=future.astype(int))
+
+    return {"mean": frame(mean), "lower": frame(mean - margin), "upper": frame(mean + margin)}
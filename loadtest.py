@@ -0,0 +1,456 @@
+#Load generator for the dashboard
+#It starts `gunicorn app:server` locally for every worker/thread combination, replays browser-like
+#sessions against it (mode switches, slider drags and country picks posted to /_dash-update-component,
+#and shared links opened through /_dash-layout) and reports throughput, tail latency and CPU/RSS per gunicorn worker.
+#
+#Example:
+#   python loadtest.py --workers 1,2,4 --threads 1,4 --sessions 16 --duration 30
+import argparse
+import json
+import random
+import string
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# psutil is needed for the per-worker CPU/RSS numbers, so runs that start gunicorn refuse to go without it.
+# Loading an already running server (--url) works without it
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def http_json(url, body=None, timeout=60, headers=None):
+    # GET (or POST when there is a body) and decode the JSON answer
+    data = None if body is None else json.dumps(body).encode()
+    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json", **(headers or {})})
+    with urllib.request.urlopen(req, timeout=timeout) as response:
+        content = response.read()
+    # A callback that raised PreventUpdate answers 204 without a body
+    return json.loads(content) if content else {}
+
+
+def walk_components(tree, found):
+    # Collecting the props of every component with an id, the same way the browser keeps its layout store
+    if isinstance(tree, list):
+        for child in tree:
+            walk_components(child, found)
+    elif isinstance(tree, dict) and "props" in tree:
+        props = tree["props"]
+        if "id" in props:
+            found[props["id"]] = props
+        walk_components(props.get("children"), found)
+    return found
+
+
+def parse_outputs(output):
+    # "..a.figure...b.figure.." -> [("a", "figure"), ("b", "figure")], duplicated outputs keep their @hash
+    if output.startswith(".."):
+        return [tuple(part.rsplit(".", 1)) for part in output[2:-2].split("...")]
+    return [tuple(output.rsplit(".", 1))]
+
+
+class DashSession:
+    # One simulated browser tab, it tracks the component props it has seen and fires the callbacks the
+    # renderer would fire for each change
+
+    def __init__(self, base_url, dependencies, record):
+        self.base_url = base_url
+        self.dependencies = dependencies
+        self.record = record
+        self.components = {}
+
+    def value(self, component_id, prop="value"):
+        return self.components[component_id][prop]
+
+    def load(self, search=""):
+        # The browser sends the page URL as the referrer of the layout request, which is how a shared link
+        # gets its selection rendered straight away
+        page = self.base_url + "/" + search
+        self.timed("GET /", lambda: urllib.request.urlopen(page, timeout=60).read())
+        layout = self.timed(
+            "GET /_dash-layout" if not search else "GET /_dash-layout (deep link)",
+            lambda: http_json(self.base_url + "/_dash-layout", headers={"Referer": page}),
+        )
+        walk_components(layout, self.components)
+
+    def timed(self, name, call):
+        start = time.perf_counter()
+        try:
+            result = call()
+        except (urllib.error.URLError, OSError, ValueError):
+            self.record(name, time.perf_counter() - start, False)
+            return None
+        self.record(name, time.perf_counter() - start, True)
+        return result
+
+    def set(self, component_id, prop, value):
+        # Same as the user changing a control, nothing is sent if the value did not change
+        if self.components[component_id].get(prop) == value:
+            return
+        self.components[component_id][prop] = value
+        for dependency in self.dependencies:
+            if any(i["id"] == component_id and i["property"] == prop for i in dependency["inputs"]):
+                self.fire(dependency, [f"{component_id}.{prop}"])
+
+    def fire(self, dependency, changed):
+        if not all(i["id"] in self.components for i in dependency["inputs"] + dependency["state"]):
+            return
+        outputs = [{"id": id_, "property": prop} for id_, prop in parse_outputs(dependency["output"])]
+        body = {
+            "output": dependency["output"],
+            "outputs": outputs if dependency["output"].startswith("..") else outputs[0],
+            "inputs": [dict(i, value=self.components[i["id"]].get(i["property"])) for i in dependency["inputs"]],
+            "changedPropIds": changed,
+            "state": [dict(s, value=self.components[s["id"]].get(s["property"])) for s in dependency["state"]],
+        }
+        answer = self.timed(
+            "POST " + ",".join(o["id"] for o in outputs),
+            lambda: http_json(self.base_url + "/_dash-update-component", body),
+        )
+        if answer:
+            self.apply(answer.get("response", {}), dependency)
+
+    def apply(self, response, source):
+        changed = []
+        for component_id, props in response.items():
+            if component_id == "mode-display":
+                self.swap_mode(props["children"])
+            elif component_id in self.components:
+                self.components[component_id].update(props)
+                changed += [f"{component_id}.{prop}" for prop in props]
+        # Like the renderer, a prop written by a callback fires the other callbacks that take it as input
+        for dependency in self.dependencies:
+            if dependency is source:
+                continue
+            triggered = [f"{i['id']}.{i['property']}" for i in dependency["inputs"]]
+            triggered = [prop for prop in triggered if prop in changed]
+            if triggered:
+                self.fire(dependency, triggered)
+
+    def swap_mode(self, children):
+        # A mode switch replaces the whole mode-display chunk. Callbacks whose inputs are in the new
+        # chunk but write somewhere outside it (the URL) run right away, like in the browser
+        old_chunk = walk_components(self.components["mode-display"].get("children"), {})
+        for component_id in old_chunk:
+            self.components.pop(component_id, None)
+        self.components["mode-display"]["children"] = children
+        new_chunk = walk_components(children, {})
+        self.components.update(new_chunk)
+        for dependency in self.dependencies:
+            inputs = [i["id"] for i in dependency["inputs"]]
+            outputs = [id_ for id_, _ in parse_outputs(dependency["output"])]
+            if all(i in new_chunk for i in inputs) and any(o not in new_chunk for o in outputs):
+                self.fire(dependency, [])
+
+
+def random_range(session, rng, slider_id):
+    first, last = session.value(slider_id, "min"), session.value(slider_id, "max")
+    start = rng.randint(first, last - 1)
+    return [start, rng.randint(start + 1, last)]
+
+
+def random_option(session, rng, radio_id):
+    return rng.choice([option["value"] for option in session.value(radio_id, "options")])
+
+
+def random_countries(session, rng, dropdown_id, low, high):
+    # The dropdowns only get options from the search callback, so countries are picked the way a user
+    # would: type a couple of letters, take one of the matches
+    wanted, picked = rng.randint(low, high), []
+    for _ in range(wanted * 5):
+        if len(picked) == wanted:
+            break
+        session.set(dropdown_id, "search_value", "".join(rng.choice(string.ascii_lowercase) for _ in range(2)))
+        matches = [option["value"] for option in session.value(dropdown_id, "options") if "search" in option]
+        matches = [country for country in matches if country not in picked]
+        if matches:
+            picked.append(rng.choice(matches))
+    return picked
+
+
+def random_deep_link(session, rng):
+    # A shared link to a random selection of any mode, including the heatmap with log colors
+    mode = rng.choice(["worldview", "single_country", "multiple_country", "year_view"])
+    start = rng.randint(1800, 2010)
+    params = [("mode", mode), ("start", start), ("end", rng.randint(start + 1, 2022))]
+    if mode in ("single_country", "multiple_country"):
+        letters = "".join(rng.choice(string.ascii_lowercase) for _ in range(2))
+        found = session.timed(
+            "GET /search/countries",
+            lambda: http_json(f"{session.base_url}/search/countries?q={letters}"),
+        ) or {}
+        matches = found.get("matches") or ["USA"]
+        params += [("country", country) for country in rng.sample(matches, 1 if mode == "single_country" else min(4, len(matches)))]
+    if mode == "worldview":
+        params += [("chart", "heatmap"), ("order", rng.choice(["total", "cluster", "name"])), ("scale", rng.choice(["linear", "log"]))]
+    elif mode == "single_country":
+        params.append(("ahead", rng.choice(["0", "10", "30"])))
+    elif mode == "multiple_country":
+        params += [("metric", rng.choice(["raw", "indexed", "growth"])), ("ahead", "10")]
+    return "?" + urllib.parse.urlencode(params)
+
+
+# Sessions that open a shared link instead of the plain page
+DEEP_LINK_SCRIPTS = {"deep_link"}
+
+# Session scripts, each step is (component id, property, value or function making the value)
+SESSION_SCRIPTS = {
+    "worldview": [
+        ("mode-selector", "value", "worldview"),
+        ("worldview-year-slider", "value", lambda s, rng: random_range(s, rng, "worldview-year-slider")),
+        ("worldview-chart", "value", lambda s, rng: rng.choice(["lines", "heatmap"])),
+        ("heatmap-order", "value", lambda s, rng: rng.choice(["total", "cluster", "name"])),
+        ("heatmap-scale", "value", lambda s, rng: rng.choice(["linear", "log"])),
+        ("worldview-year-slider", "value", lambda s, rng: random_range(s, rng, "worldview-year-slider")),
+        ("worldview-year-slider", "value", lambda s, rng: random_range(s, rng, "worldview-year-slider")),
+    ],
+    "single_country": [
+        ("mode-selector", "value", "single_country"),
+        ("country-dropdown", "value", lambda s, rng: random_countries(s, rng, "country-dropdown", 1, 1)[0]),
+        ("year-slider", "value", lambda s, rng: random_range(s, rng, "year-slider")),
+        ("forecast-years", "value", lambda s, rng: random_option(s, rng, "forecast-years")),
+        ("country-dropdown", "value", lambda s, rng: random_countries(s, rng, "country-dropdown", 1, 1)[0]),
+    ],
+    "multiple_country": [
+        ("mode-selector", "value", "multiple_country"),
+        ("multiple-country-dropdown", "value", lambda s, rng: random_countries(s, rng, "multiple-country-dropdown", 2, 6)),
+        ("multiple-year-slider", "value", lambda s, rng: random_range(s, rng, "multiple-year-slider")),
+        ("comparison-metric", "value", lambda s, rng: rng.choice(["raw", "indexed", "growth"])),
+        ("multiple-forecast-years", "value", lambda s, rng: random_option(s, rng, "multiple-forecast-years")),
+        ("multiple-country-dropdown", "value", lambda s, rng: random_countries(s, rng, "multiple-country-dropdown", 10, 40)),
+    ],
+    "year_view": [
+        ("mode-selector", "value", "year_view"),
+        ("single-year-slider", "value", lambda s, rng: rng.randint(s.value("single-year-slider", "min"), s.value("single-year-slider", "max"))),
+        ("single-year-slider", "value", lambda s, rng: rng.randint(s.value("single-year-slider", "min"), s.value("single-year-slider", "max"))),
+    ],
+    # Opens on a random shared link, then changes the range of whichever mode the link rendered
+    # (steps for controls the page does not have are skipped)
+    "deep_link": [
+        ("worldview-year-slider", "value", lambda s, rng: random_range(s, rng, "worldview-year-slider")),
+        ("heatmap-scale", "value", lambda s, rng: rng.choice(["linear", "log"])),
+        ("year-slider", "value", lambda s, rng: random_range(s, rng, "year-slider")),
+        ("multiple-year-slider", "value", lambda s, rng: random_range(s, rng, "multiple-year-slider")),
+        ("single-year-slider", "value", lambda s, rng: rng.randint(s.value("single-year-slider", "min"), s.value("single-year-slider", "max"))),
+    ],
+}
+
+
+def run_user(base_url, dependencies, scripts, deadline, think, seed, record):
+    # One virtual user: open the page, play a random script, repeat until time is up
+    rng = random.Random(seed)
+    while time.time() < deadline:
+        session = DashSession(base_url, dependencies, record)
+        script = rng.choice(scripts)
+        session.load(random_deep_link(session, rng) if script in DEEP_LINK_SCRIPTS else "")
+        if "mode-selector" not in session.components:
+            time.sleep(0.5)
+            continue
+        for component_id, prop, value in SESSION_SCRIPTS[script]:
+            if time.time() >= deadline:
+                return
+            if component_id not in session.components:
+                continue
+            if callable(value):
+                value = value(session, rng)
+            session.set(component_id, prop, value)
+            time.sleep(rng.uniform(0, 2 * think))
+
+
+class WorkerMonitor:
+    # Samples CPU time and RSS of every gunicorn worker while the load runs
+    def __init__(self, master_pid, interval=0.5):
+        self.master_pid = master_pid
+        self.interval = interval
+        self.workers = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.started = time.time()
+        self._sample()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        self.elapsed = time.time() - self.started
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        try:
+            children = psutil.Process(self.master_pid).children()
+        except psutil.Error:
+            return
+        for child in children:
+            try:
+                with child.oneshot():
+                    cpu = child.cpu_times()
+                    rss = child.memory_info().rss
+            except psutil.Error:
+                continue
+            stats = self.workers.setdefault(child.pid, {"cpu_first": cpu.user + cpu.system, "rss_max": 0})
+            stats["cpu_last"] = cpu.user + cpu.system
+            stats["rss_max"] = max(stats["rss_max"], rss)
+
+    def report(self):
+        return {
+            pid: {
+                "cpu_percent": 100 * (stats["cpu_last"] - stats["cpu_first"]) / self.elapsed,
+                "rss_mb": stats["rss_max"] / 2 ** 20,
+            }
+            for pid, stats in sorted(self.workers.items())
+        }
+
+
+def start_gunicorn(workers, threads, port):
+    command = [
+        sys.executable, "-m", "gunicorn", "app:server",
+        "--workers", str(workers),
+        "--threads", str(threads),
+        "--bind", f"127.0.0.1:{port}",
+        "--log-level", "warning",
+    ]
+    process = subprocess.Popen(command)
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(240):
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {process.returncode}")
+        try:
+            urllib.request.urlopen(base_url + "/_dash-dependencies", timeout=5).read()
+            return process, base_url
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.25)
+    process.terminate()
+    raise RuntimeError("gunicorn did not come up within 60 seconds")
+
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def run_load(base_url, args, master_pid=None):
+    dependencies = http_json(base_url + "/_dash-dependencies")
+    samples = []
+    lock = threading.Lock()
+
+    def record(name, seconds, ok):
+        with lock:
+            samples.append((name, seconds, ok))
+
+    monitor = WorkerMonitor(master_pid) if psutil and master_pid else None
+    if monitor:
+        monitor.start()
+    started = time.time()
+    deadline = started + args.duration
+    users = [
+        threading.Thread(
+            target=run_user,
+            args=(base_url, dependencies, args.scripts, deadline, args.think, args.seed + n, record),
+            daemon=True,
+        )
+        for n in range(args.sessions)
+    ]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    elapsed = time.time() - started
+    if monitor:
+        monitor.stop()
+
+    latencies = [seconds * 1000 for _, seconds, ok in samples if ok]
+    # Per request name: every callback, the page and layout loads (plain and deep link) and the country search
+    by_request = {}
+    for name, seconds, ok in samples:
+        if ok:
+            by_request.setdefault(name, []).append(seconds * 1000)
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for _, _, ok in samples if not ok),
+        "throughput": len(samples) / elapsed,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "by_request": {
+            name: {"count": len(values), "p95_ms": percentile(values, 95)}
+            for name, values in sorted(by_request.items())
+        },
+        "workers": monitor.report() if monitor else {},
+    }
+
+
+def print_result(label, result):
+    print(
+        f"{label:<22}{result['requests']:>9}{result['errors']:>8}{result['throughput']:>9.1f}"
+        f"{result['p50_ms']:>9.0f}{result['p95_ms']:>9.0f}{result['p99_ms']:>9.0f}"
+    )
+    for name, stats in result["by_request"].items():
+        print(f"    {name:<80} n={stats['count']:<6} p95={stats['p95_ms']:.0f}ms")
+    for pid, stats in result["workers"].items():
+        print(f"    worker {pid}: cpu {stats['cpu_percent']:.0f}%  rss {stats['rss_mb']:.0f} MB")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay dashboard sessions against gunicorn and report throughput and latency")
+    parser.add_argument("--workers", default="1,2,4", help="comma separated gunicorn worker counts")
+    parser.add_argument("--threads", default="1,4", help="comma separated gunicorn thread counts")
+    parser.add_argument("--sessions", type=int, default=16, help="concurrent simulated users")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load per configuration")
+    parser.add_argument("--think", type=float, default=0.5, help="mean pause in seconds between user actions")
+    parser.add_argument("--scripts", default=",".join(SESSION_SCRIPTS), help="comma separated session scripts to replay")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--url", help="load an already running server instead of starting gunicorn")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    args = parser.parse_args()
+    args.scripts = args.scripts.split(",")
+    unknown = set(args.scripts) - set(SESSION_SCRIPTS)
+    if unknown:
+        parser.error(f"unknown session scripts: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main():
+    args = parse_args()
+    if psutil is None and not args.url:
+        sys.exit("psutil is needed for the per-worker CPU/RSS numbers, install it with: pip install psutil")
+
+    results = []
+    print(f"{'config':<22}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    if args.url:
+        result = run_load(args.url.rstrip("/"), args)
+        print_result(args.url, result)
+        results.append(dict(result, url=args.url))
+    else:
+        for workers in (int(w) for w in args.workers.split(",")):
+            for threads in (int(t) for t in args.threads.split(",")):
+                process, base_url = start_gunicorn(workers, threads, args.port)
+                try:
+                    result = run_load(base_url, args, process.pid)
+                finally:
+                    process.terminate()
+                    process.wait()
+                print_result(f"{workers} workers x {threads} thr", result)
+                results.append(dict(result, workers=workers, threads=threads))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+#On-demand sampling profiler for the dashboard server
+#It is only installed when PROFILER_TOKEN is set (see app.py), so a normal deploy runs none of this code.
+#A capture samples the Python stacks of the threads that are serving a request every few milliseconds, either
+#for a time window or while the next N requests to one named callback are being handled, and writes:
+#   <name>.folded  collapsed stacks, opens directly in speedscope or flamegraph.pl
+#   <name>.txt     top functions by self and total samples
+#
+#Every gunicorn worker has its own profiler, so a capture only sees the worker that got the start request.
+import hmac
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import abort, jsonify, request
+from werkzeug.wsgi import ClosingIterator
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse(frame):
+    # Root first, the way the collapsed stack format wants it
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+def top_functions(stacks, limit=30):
+    # Self samples count the leaf frame only, total samples count every function once per stack
+    total_samples = sum(stacks.values())
+    self_counts, total_counts = Counter(), Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        self_counts[frames[-1]] += count
+        for label in set(frames):
+            total_counts[label] += count
+
+    lines = [f"{total_samples} samples", f"{'self %':>8}{'total %':>9}  function"]
+    for label, count in self_counts.most_common(limit):
+        lines.append(
+            f"{100 * count / total_samples:>8.1f}{100 * total_counts[label] / total_samples:>9.1f}  {label}"
+        )
+    return "\n".join(lines)
+
+
+class SamplingProfiler:
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.capture = None
+        self.last_result = None
+        # Threads in the middle of a request, idle workers waiting for a connection are never sampled
+        self.serving = set()
+        self._lock = threading.Lock()
+
+    def start(self, seconds=None, callback=None, requests=None, interval=0.005):
+        with self._lock:
+            if self.capture is not None:
+                return False
+            self.capture = {
+                "label": callback or "window",
+                "callback": callback,
+                "requests_left": requests,
+                # None means every thread serving a request, otherwise only the threads serving the named callback
+                "threads": set() if callback else None,
+                "deadline": time.time() + seconds if seconds else None,
+                "interval": interval,
+                "stacks": Counter(),
+                "started": time.time(),
+            }
+            capture = self.capture
+        threading.Thread(target=self._sample, args=(capture,), daemon=True).start()
+        return True
+
+    def stop(self):
+        with self._lock:
+            capture, self.capture = self.capture, None
+        if capture is not None:
+            self.last_result = self._write(capture)
+        return self.last_result
+
+    def _sample(self, capture):
+        own_thread = threading.get_ident()
+        while self.capture is capture:
+            if capture["deadline"] and time.time() >= capture["deadline"]:
+                self.stop()
+                return
+            threads = self.serving if capture["threads"] is None else capture["threads"]
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread or thread_id not in threads:
+                    continue
+                capture["stacks"][collapse(frame)] += 1
+            time.sleep(capture["interval"])
+
+    def _write(self, capture):
+        os.makedirs(self.output_dir, exist_ok=True)
+        name = time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}-{capture['label']}"
+        base = os.path.join(self.output_dir, name)
+        with open(base + ".folded", "w") as f:
+            for stack, count in capture["stacks"].most_common():
+                f.write(f"{stack} {count}\n")
+        summary = top_functions(capture["stacks"]) if capture["stacks"] else "no samples"
+        with open(base + ".txt", "w") as f:
+            f.write(summary + "\n")
+        return {
+            "folded": base + ".folded",
+            "summary": base + ".txt",
+            "seconds": round(time.time() - capture["started"], 3),
+            "top": summary,
+        }
+
+    # The two request hooks below only do work while a callback capture is running
+
+    def request_started(self, callback_name):
+        capture = self.capture
+        if capture is None or capture["callback"] is None or capture["callback"] != callback_name:
+            return False
+        capture["threads"].add(threading.get_ident())
+        return True
+
+    def request_finished(self):
+        # Several threads can finish a sampled request at the same time, only one of them may end the capture
+        with self._lock:
+            capture = self.capture
+            if capture is None or capture["threads"] is None:
+                return
+            capture["threads"].discard(threading.get_ident())
+            capture["requests_left"] -= 1
+            finished = capture["requests_left"] == 0
+        if finished:
+            self.stop()
+
+    def wrap_wsgi(self, wsgi_app):
+        # Marks the thread as serving from the start of a request until its response is fully sent, which for
+        # a streamed response (the exports) is long after the request hooks have run.
+        # The profiler's own endpoints are left out, they would only show the capture being started or stopped
+        def profiled_wsgi_app(environ, start_response):
+            if environ.get("PATH_INFO", "").startswith("/_profiler/"):
+                return wsgi_app(environ, start_response)
+            thread_id = threading.get_ident()
+            self.serving.add(thread_id)
+            try:
+                response = wsgi_app(environ, start_response)
+            except BaseException:
+                self.serving.discard(thread_id)
+                raise
+            return ClosingIterator(response, lambda: self.serving.discard(thread_id))
+
+        return profiled_wsgi_app
+
+
+def install_profiler(app, token, output_dir="profiles"):
+    # Adding the /_profiler endpoints and the request hooks to a Dash app, every call needs the admin token
+    server = app.server
+    profiler = SamplingProfiler(output_dir)
+
+    def check_token():
+        # Only as a header, a query parameter would end up in the access logs
+        if not hmac.compare_digest(request.headers.get("X-Profiler-Token", "").encode(), token.encode()):
+            abort(403)
+
+    def callback_name():
+        # Which of the app's callbacks this /_dash-update-component request is for
+        body = request.get_json(silent=True) or {}
+        entry = app.callback_map.get(body.get("output"))
+        return entry["callback"].__name__ if entry else None
+
+    server.wsgi_app = profiler.wrap_wsgi(server.wsgi_app)
+
+    @server.before_request
+    def profile_callback_request():
+        if profiler.capture is not None and request.path.endswith("/_dash-update-component"):
+            request.environ["profiler.sampled"] = profiler.request_started(callback_name())
+
+    @server.teardown_request
+    def finish_callback_request(exc):
+        if request.environ.get("profiler.sampled"):
+            profiler.request_finished()
+
+    @server.route("/_profiler/start", methods=["POST"])
+    def profiler_start():
+        check_token()
+        callback = request.args.get("callback")
+        seconds = request.args.get("seconds", None if callback else 10, type=float)
+        known_callbacks = {entry["callback"].__name__ for entry in app.callback_map.values()}
+        requests = request.args.get("requests", 1, type=int)
+        interval = request.args.get("interval", 0.005, type=float)
+        if callback and callback not in known_callbacks:
+            abort(400, f"unknown callback {callback}")
+        # A capture that could never end, or a sampler that would crash and leave the capture stuck, is refused
+        if seconds is not None and not 0 < seconds < math.inf:
+            abort(400, "seconds has to be a positive number")
+        if requests < 1:
+            abort(400, "requests has to be at least 1")
+        if not 0 < interval < math.inf:
+            abort(400, "interval has to be a positive number")
+        started = profiler.start(seconds=seconds, callback=callback, requests=requests, interval=interval)
+        if not started:
+            abort(409, "a capture is already running")
+        return jsonify({"started": True, "callback": callback, "seconds": seconds})
+
+    @server.route("/_profiler/stop", methods=["POST"])
+    def profiler_stop():
+        check_token()
+        return jsonify(profiler.stop())
+
+    @server.route("/_profiler/status")
+    def profiler_status():
+        check_token()
+        return jsonify({"running": profiler.capture is not None, "last": profiler.last_result})
+
+    return profiler